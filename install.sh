@@ -179,12 +179,18 @@ if ! [ -f "/opt/OpenBlok/system.json" ]; then
             "local": {
                 "path": "/opt/OpenBlok/images",
                 "maxSizeGB": 10,
-                "enabled": true
+                "enabled": true,
+                "format": "png",
+                "compressionLevel": 1,
+                "writers": 2,
+                "writeQueueSize": 30
             },
             "redis": {
                 "host": "localhost",
                 "port": 6379,
-                "password": null
+                "password": null,
+                "socket": null,
+                "sharedMemory": true
             }
         }
     }' > /opt/OpenBlok/system.json
@@ -4,13 +4,17 @@ Manages the storage of images both locally and on the cloud.
 '''
 
 import os
+import glob
+import mmap
 import uuid
-import json
 import time
-import struct
+import queue
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
 
 import cv2
 import redis
+import orjson
 import numpy as np
 
 from modules import ob_system
@@ -19,6 +23,47 @@ from modules import ob_system
 # ---------------------------------------------------------------------------- #
 #                                 Local Storage                                #
 # ---------------------------------------------------------------------------- #
+def release_shared_frame(shm_name):
+    '''
+    Unlinks a queued frame from shared memory without writing it.
+    '''
+    frame_shm = shared_memory.SharedMemory(name=shm_name)
+    frame_shm.close()
+    frame_shm.unlink()
+
+
+def image_writer(image_queue, current_size, encode_params):
+    '''
+    Background process, encodes queued frames and writes them to disk.
+    Frames are handed over in shared memory to avoid pickling them.
+    '''
+    while True:
+        image_path, shm_name, shape = image_queue.get()
+        frame_shm = shared_memory.SharedMemory(name=shm_name)
+
+        try:
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=frame_shm.buf)
+            _, encoded = cv2.imencode(os.path.splitext(image_path)[1], frame, encode_params)
+
+            # Unbuffered write straight from the encoded buffer, no fsync.
+            image_fd = os.open(image_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                image_data = memoryview(encoded).cast('B')
+                while image_data:
+                    image_data = image_data[os.write(image_fd, image_data):]
+            finally:
+                os.close(image_fd)
+
+            with current_size.get_lock():
+                current_size.value += encoded.nbytes
+        except (OSError, cv2.error) as err:
+            print(f"WARNING | Unable to save image {image_path}: {err}")
+        finally:
+            frame = None    # Release the view so the shared memory can be closed
+            frame_shm.close()
+            frame_shm.unlink()
+
+
 class LocalStorageManager:
     '''Adds images to the local storage and manages the local storage.'''
 
@@ -38,46 +83,106 @@ class LocalStorageManager:
         '''
         if hasattr(self, 'current_size'):
             return
-        self.current_size = 0
+        self.current_size = multiprocessing.Value('Q', 0)   # Shared with the writers
         self.session_id = str(round(time.time()))
+        self.enabled = ob_system.get(['storage', 'local', 'enabled'])
         self.path = ob_system.get(['storage', 'local', 'path'])
         self.max_size_gb = ob_system.get(['storage', 'local', 'maxSizeGB'])
         self.max_size_bytes = self.max_size_gb * 1024 * 1024 * 1024
+        # Normalized so the file extension always matches the encoder parameters.
+        self.image_format = str(ob_system.get(['storage', 'local', 'format'], 'png')).lower()
+        if self.image_format == 'jpeg':
+            self.image_format = 'jpg'
+        elif self.image_format not in ('png', 'jpg'):
+            print(f"WARNING | Unsupported image format {self.image_format}, using png.")
+            self.image_format = 'png'
+
+        if self.image_format == 'jpg':
+            self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, 90]
+        else:
+            self.encode_params = [
+                cv2.IMWRITE_PNG_COMPRESSION,
+                ob_system.get(['storage', 'local', 'compressionLevel'], 1),
+                cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE
+            ]
 
         os.makedirs(self.path, exist_ok=True)
         os.makedirs(os.path.join(self.path, self.session_id), exist_ok=True)
         self.calculate_current_size()
 
+        # ------------------------------ Image Writers ------------------------------ #
+        if self.enabled:
+            # Writers must share this process's resource tracker to unlink frames cleanly.
+            resource_tracker.ensure_running()
+            self.image_queue = multiprocessing.Queue(
+                maxsize=ob_system.get(['storage', 'local', 'writeQueueSize'], 30))
+
+            for _ in range(ob_system.get(['storage', 'local', 'writers'], 2)):
+                writer_process = multiprocessing.Process(
+                    target=image_writer,
+                    args=(self.image_queue, self.current_size, self.encode_params)
+                )
+                writer_process.daemon = True
+                writer_process.start()
+
     def calculate_current_size(self):
         '''
         Calculate the current size of the local storage
+        Uses the cached stat of each directory entry, one syscall per file.
         '''
-        for path, _, files in os.walk(self.path):
-            for file in files:
-                self.current_size += os.path.getsize(os.path.join(path, file))
-
-    def add_image(self, frame, frame_name=uuid.uuid4()):
+        directories = [self.path]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    else:
+                        self.current_size.value += entry.stat(follow_symlinks=False).st_size
+
+    def add_image(self, frame, frame_name=None):
         '''
         Add an image to the local storage
         '''
-        if not ob_system.get(['storage', 'local', 'enabled']):
+        if not self.enabled:
             # print("WARNING | Local storage is disabled. Can't save image.")
             return
 
-        if self.current_size < self.max_size_bytes:
-            image_path = os.path.join(self.path, self.session_id, str(frame_name) + '.png')
-            cv2.imwrite(image_path, frame)
-            self.current_size += os.path.getsize(image_path)
-        else:
+        if self.current_size.value >= self.max_size_bytes:
             print("WARNING | Local storage is full. Can't save image.")
+            return
+
+        if frame_name is None:
+            frame_name = uuid.uuid4().hex
+
+        image_path = os.path.join(
+            self.path, self.session_id, f"{frame_name}.{self.image_format}")
+
+        frame_shm = shared_memory.SharedMemory(create=True, size=frame.nbytes)
+        shared_frame = np.ndarray(frame.shape, dtype=np.uint8, buffer=frame_shm.buf)
+        shared_frame[:] = frame
+        del shared_frame
+        frame_shm.close()
+
+        queued_image = (image_path, frame_shm.name, frame.shape)
+        try:
+            self.image_queue.put_nowait(queued_image)
+        except queue.Full:
+            # Writers are behind, drop the oldest queued frame to make room.
+            print("WARNING | Image writers are behind. Dropping oldest queued image.")
+            try:
+                release_shared_frame(self.image_queue.get_nowait()[1])
+                self.image_queue.put_nowait(queued_image)
+            except (queue.Empty, queue.Full):
+                release_shared_frame(frame_shm.name)
 
     def session_metadata(self, metadata):
         '''
         Store session metadata in a file
         '''
         metadata_path = os.path.join(self.path, self.session_id, 'metadata.json')
-        with open(metadata_path, 'w', encoding="UTF-8") as metadata_file:
-            json.dump(metadata, metadata_file, indent=4)
+        with open(metadata_path, 'wb') as metadata_file:
+            metadata_file.write(orjson.dumps(
+                metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
 
 # ---------------------------------------------------------------------------- #
@@ -89,37 +194,156 @@ class RedisStorageManager():
     HOST = ob_system.get(['storage', 'redis', 'host'])
     PORT = ob_system.get(['storage', 'redis', 'port'])
     PASSWORD = ob_system.get(['storage', 'redis', 'password'])
+    SOCKET = ob_system.get(['storage', 'redis', 'socket'])
+    SHARED_MEMORY = ob_system.get(['storage', 'redis', 'sharedMemory'], False)
+    SHARED_MEMORY_PATH = '/dev/shm'
+    MAX_CONNECTIONS = 8     # Per process, covers the worker threads sharing a manager
+
+    # KEYS: frame, queue | ARGV: frame uuid, field, value, field, value...
+    ENQUEUE_FRAME_SCRIPT = """
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+        redis.call('RPUSH', KEYS[2], ARGV[1])
+        return 1
+    """
+
+    # KEYS: frame, new frame, new queue, queue shape | ARGV: frame uuid
+    MOVE_FRAME_SCRIPT = """
+        local shape = redis.call('GET', KEYS[4])
+        redis.call('RENAME', KEYS[1], KEYS[2])
+        if shape then
+            redis.call('HSETNX', KEYS[2], 'shape', shape)
+        end
+        redis.call('RPUSH', KEYS[3], ARGV[1])
+        return 1
+    """
 
     def __init__(self):
-        self.redis = redis.Redis(host=self.HOST, port=self.PORT, password=self.PASSWORD)
+        if self.SOCKET:
+            # Redis on the same host, skip the TCP stack.
+            connection_pool = redis.BlockingConnectionPool(
+                connection_class=redis.UnixDomainSocketConnection,
+                path=self.SOCKET, password=self.PASSWORD,
+                max_connections=self.MAX_CONNECTIONS
+            )
+        else:
+            connection_pool = redis.BlockingConnectionPool(
+                host=self.HOST, port=self.PORT, password=self.PASSWORD,
+                socket_keepalive=True, max_connections=self.MAX_CONNECTIONS
+            )
+
+        self.redis = redis.Redis(connection_pool=connection_pool)
+        self._shape_cache = {}  # Frame shape registered for each queue
+        self._enqueue_frame = self.redis.register_script(self.ENQUEUE_FRAME_SCRIPT)
+        self._move_frame = self.redis.register_script(self.MOVE_FRAME_SCRIPT)
+
+    def _queue_shape(self, queue_name, frame_shape=None):
+        '''
+        Returns the frame shape registered for a queue, stored once as "{queue}:shape".
+        The first producer to pass a frame_shape registers it.
+        '''
+        if queue_name not in self._shape_cache:
+            shape_key = f"{queue_name}:shape"
+            if frame_shape is not None and self.redis.set(
+                    shape_key, ",".join(map(str, frame_shape)), nx=True):
+                self._shape_cache[queue_name] = tuple(frame_shape)
+            else:
+                self._shape_cache[queue_name] = tuple(
+                    int(dim) for dim in self.redis.get(shape_key).split(b","))
+
+        return self._shape_cache[queue_name]
+
+    @staticmethod
+    def _frame_key(queue_name, frame_uuid):
+        '''
+        Returns the key of a frame hash.
+        frame_uuid is the raw 16 byte UUID used on the wire, or its string form from metadata.
+        '''
+        if isinstance(frame_uuid, str):
+            frame_uuid = uuid.UUID(frame_uuid).bytes
+        return b"%s:%s" % (queue_name.encode(), frame_uuid)
+
+    def _shared_frame_path(self, frame_uuid):
+        '''
+        Returns the shared memory file holding a frame's pixels.
+        '''
+        if isinstance(frame_uuid, str):
+            frame_uuid = uuid.UUID(frame_uuid).bytes
+        return os.path.join(self.SHARED_MEMORY_PATH, f"openblok_{frame_uuid.hex()}")
+
+    @staticmethod
+    def _map_shared_frame(shm_path, frame_shape, release):
+        '''
+        Maps a frame from shared memory as a read-only array without copying it.
+        Once released the file is unlinked, the mapping stays valid until the array is freed.
+        '''
+        with open(shm_path, 'rb') as shm_file:
+            frame_map = mmap.mmap(shm_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if release:
+            os.unlink(shm_path)
+
+        return np.frombuffer(frame_map, dtype=np.uint8).reshape(frame_shape)
 
     def clear_db(self):
         for key in self.redis.scan_iter("*"):
             self.redis.delete(key)
 
+        for shm_path in glob.glob(os.path.join(self.SHARED_MEMORY_PATH, "openblok_*")):
+            os.unlink(shm_path)
+
     def add_frame(self, queue_name, frame, metadata=None):
         '''
         Adds a frame to the redis queue
         '''
         time_start = time.time()
-        frame_uuid = str(uuid.uuid4())
+        frame_uuid = uuid.uuid4().bytes
 
         if metadata is None:
             metadata = {}
 
-        frame_height, frame_width = frame.shape[:2]
-        shape = struct.pack('>II', frame_height, frame_width)
-        frame_bytes = shape + frame.tobytes()
-
-        metadata[f"{queue_name}UUID"] = frame_uuid
-        key = f"{queue_name}:{frame_uuid}"
-
-        with self.redis.pipeline() as pipe:
-            pipe.hset(key, "frame", frame_bytes)
-            pipe.hset(key, "metadata", json.dumps(metadata))
-            pipe.hset(key, "add_frame_time", time.time()-time_start)
-            pipe.rpush(f"{queue_name}_queue", frame_uuid)
-            pipe.execute()
+        metadata[f"{queue_name}UUID"] = frame_uuid.hex()    # JSON safe form
+
+        frame_data = memoryview(np.ascontiguousarray(frame)).cast('B')
+        frame_fields = {"metadata": orjson.dumps(metadata, option=orjson.OPT_SERIALIZE_NUMPY)}
+
+        # Only frames that differ from the queue's registered shape carry their own.
+        if frame.shape != self._queue_shape(queue_name, frame.shape):
+            frame_fields["shape"] = ",".join(map(str, frame.shape))
+
+        if self.SHARED_MEMORY:
+            # Pixels skip Redis entirely, only the shared memory file is referenced.
+            # Owner only, raw camera frames should not be readable by other users.
+            shm_path = self._shared_frame_path(frame_uuid)
+            shm_fd = os.open(shm_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                with open(shm_fd, 'wb') as shm_file:
+                    shm_file.write(frame_data)
+            except OSError:
+                os.unlink(shm_path)
+                raise
+            frame_fields["frame_shm"] = shm_path
+        else:
+            # Pixels are sent as a memoryview so redis-py writes the buffer without a copy.
+            frame_fields["frame"] = frame_data
+
+        frame_fields["add_frame_time"] = time.time()-time_start
+
+        if self.SHARED_MEMORY:
+            # Small arguments, hash and queue entry are written atomically in one command.
+            try:
+                self._enqueue_frame(
+                    keys=[self._frame_key(queue_name, frame_uuid), f"{queue_name}_queue"],
+                    args=[frame_uuid, *(item for field in frame_fields.items() for item in field)]
+                )
+            except Exception:
+                os.unlink(shm_path)     # No hash references it, it would leak until clear_db
+                raise
+        else:
+            # Script arguments are copied into Lua, keep the pixels on a plain MULTI/EXEC HSET.
+            with self.redis.pipeline() as pipe:
+                pipe.hset(self._frame_key(queue_name, frame_uuid), mapping=frame_fields)
+                pipe.rpush(f"{queue_name}_queue", frame_uuid)
+                pipe.execute()
 
         return frame_uuid
 
@@ -129,27 +353,75 @@ class RedisStorageManager():
         '''
         time_start = time.time()
         if frame_uuid is None:
-            frame_uuid = self.redis.blpop([f"{queue_name}_queue"], timeout=30)[1].decode("utf-8")
-        elif isinstance(frame_uuid, bytes):
-            frame_uuid = frame_uuid.decode("utf-8")
+            frame_uuid = self.redis.blpop([f"{queue_name}_queue"], timeout=30)[1]
 
+        frame_key = self._frame_key(queue_name, frame_uuid)
         with self.redis.pipeline() as pipe:
-            pipe.hgetall(f"{queue_name}:{frame_uuid}")
+            pipe.hgetall(frame_key)
             if delete_frame:
-                pipe.delete(f"{queue_name}:{frame_uuid}")
+                pipe.delete(frame_key)
             frame_object = pipe.execute()[0]
 
-        frame_object = {key.decode("utf-8"): value for key, value in frame_object.items()}
+        return self._decode_frame(queue_name, frame_object, time_start, delete_frame)
+
+    def get_frames(self, queue_name, count=8, delete_frame=True):
+        '''
+        Gets up to count frames from the redis queue in a single round trip.
+        Falls back to a blocking get_frame when the queue is empty.
+        '''
+        time_start = time.time()
+
+        # Plain LPOPs in one MULTI/EXEC, LPOP with a count needs Redis 6.2+ (Ubuntu 22.04 ships 6.0).
+        with self.redis.pipeline() as pipe:
+            for _ in range(count):
+                pipe.lpop(f"{queue_name}_queue")
+            frame_uuids = [frame_uuid for frame_uuid in pipe.execute() if frame_uuid is not None]
 
-        frame_height, frame_width = struct.unpack('>II', frame_object["frame"][:8])
-        frame_decoded = np.frombuffer(
-            frame_object["frame"][8:],
-            dtype=np.uint8, count=frame_height*frame_width*3
-        ).reshape(frame_height, frame_width, 3)
+        if not frame_uuids:
+            return [self.get_frame(queue_name, delete_frame)]
+
+        with self.redis.pipeline() as pipe:
+            for frame_uuid in frame_uuids:
+                frame_key = self._frame_key(queue_name, frame_uuid)
+                pipe.hgetall(frame_key)
+                if delete_frame:
+                    pipe.delete(frame_key)
+            frame_objects = pipe.execute()[::2 if delete_frame else 1]
+
+        frames = []
+        for frame_object in frame_objects:
+            # Frames deleted by another consumer in the meantime come back empty or unlinked.
+            try:
+                if frame_object:
+                    frames.append(
+                        self._decode_frame(queue_name, frame_object, time_start, delete_frame))
+            except FileNotFoundError:
+                continue
+
+        return frames
+
+    def _decode_frame(self, queue_name, frame_object, time_start, release=False):
+        '''
+        Converts a raw redis hash into a frame and its metadata
+        release unlinks the frame's shared memory, set when the hash was deleted.
+        '''
+        # Field names stay as the bytes redis returns, no per-frame decode.
+        if b"shape" in frame_object:
+            frame_shape = tuple(int(dim) for dim in frame_object[b"shape"].split(b","))
+        else:
+            frame_shape = self._queue_shape(queue_name)
+
+        # Zero-copy, read-only views over the redis bytes or shared memory; copy before drawing.
+        if b"frame_shm" in frame_object:
+            frame_decoded = self._map_shared_frame(
+                frame_object[b"frame_shm"], frame_shape, release)
+        else:
+            frame_decoded = np.frombuffer(
+                frame_object[b"frame"], dtype=np.uint8).reshape(frame_shape)
 
         frame_object = {
-            "frame": frame_decoded.copy(),
-            "metadata": json.loads(frame_object["metadata"].decode("utf-8"))
+            "frame": frame_decoded,
+            "metadata": orjson.loads(frame_object[b"metadata"])
         }
 
         frame_object["metadata"]["get_frame_time"] = time.time()-time_start
@@ -160,21 +432,43 @@ class RedisStorageManager():
         '''
         Adds metadata to a frame in the redis queue
         '''
-        if isinstance(frame_uuid, bytes):
-            frame_uuid = frame_uuid.decode("utf-8")
+        if not metadata:
+            return
 
-        for key, value in metadata.items():
-            self.redis.hset(f"{queue_name}:{frame_uuid}", key, value)
+        # One multi-field HSET, values redis can't store directly are stored as JSON.
+        self.redis.hset(self._frame_key(queue_name, frame_uuid), mapping={
+            key: value
+            if isinstance(value, (bytes, str, int, float)) and not isinstance(value, bool)
+            else orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+            for key, value in metadata.items()
+        })
 
     def move_frame(self, queue_name, new_queue_name, frame_uuid):
         '''
         Moves a frame from one queue to another
         '''
-        self.redis.rename(f"{queue_name}:{frame_uuid}", f"{new_queue_name}:{frame_uuid}")
-        self.redis.rpush(new_queue_name, frame_uuid)
+        if isinstance(frame_uuid, str):
+            frame_uuid = uuid.UUID(frame_uuid).bytes
+
+        # Atomic, a crash can't leave a renamed frame missing from its queue.
+        # The source queue's shape is kept on the frame in case the new queue's differs.
+        self._move_frame(
+            keys=[
+                self._frame_key(queue_name, frame_uuid),
+                self._frame_key(new_queue_name, frame_uuid),
+                f"{new_queue_name}_queue", f"{queue_name}:shape"
+            ],
+            args=[frame_uuid]
+        )
 
     def delete_frame(self, queue_name, frame_uuid):
         '''
         Deletes a frame from the redis queue
         '''
-        self.redis.delete(f"{queue_name}:{frame_uuid}")
+        self.redis.delete(self._frame_key(queue_name, frame_uuid))
+
+        if self.SHARED_MEMORY:
+            try:
+                os.unlink(self._shared_frame_path(frame_uuid))
+            except FileNotFoundError:
+                pass
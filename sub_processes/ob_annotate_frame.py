@@ -25,7 +25,7 @@ def annotations(AruCo_corners, AruCo_ids, AruCo_center_x, mirror_offset, AruCo_p
     while True:
         try:
             predicted_frame_object = redis_db.get_frame("predicted")
-            predicted_frame = predicted_frame_object['frame']
+            predicted_frame = predicted_frame_object['frame'].copy()     # Drawn on in place
             predicted_metadata = predicted_frame_object['metadata']
 
             # Add frame time to stats
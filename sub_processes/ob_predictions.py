@@ -5,6 +5,8 @@ Performs predictions on the frames in the queue.
 '''
 
 import time
+import queue
+import threading
 
 import numpy as np
 
@@ -16,16 +18,61 @@ from modeled import location, e2e
 
 redis_db = ob_storage.RedisStorageManager()
 
+CROP_PIXELS = 600   # Side length of each view crop fed to the e2e model
+
+
+def prefetch_frames(roi_queue):
+    '''
+    Fetches roi frames from Redis in batches while the models run.
+    '''
+    while True:
+        try:
+            # Only fetch what fits in the queue, so few frames are held and go stale.
+            for roi_frame_object in redis_db.get_frames("roi", count=roi_queue.maxsize):
+                roi_queue.put(roi_frame_object)
+        except Exception as e:
+            print(e)
+            time.sleep(1)   # Back off, errors like a downed Redis repeat immediately
+
+
+def store_predictions(predicted_queue):
+    '''
+    Pairs the predictions with their raw frame and stores them in Redis.
+    '''
+    while True:
+        predicted_metadata = predicted_queue.get()
+
+        # rotated_frame_object = redis_db.get_frame(
+        #     "rotated", frame_uuid=predicted_metadata['rotatedUUID'])
+
+        try:
+            rotated_frame_object = redis_db.get_frame(
+                "raw", frame_uuid=predicted_metadata['rawUUID'])
+
+            redis_db.add_frame("predicted", rotated_frame_object['frame'], predicted_metadata)
+        except Exception as e:
+            print(e)
+
 
 def run_models():
     '''
     runs models on frames in the queue, stores results in Redis
+    Redis reads and writes run in their own threads so inference does not wait on them.
     '''
     location_model = location.LocationInference()
     e2e_model = e2e.PartInference()
 
+    roi_queue = queue.Queue(maxsize=2)
+    predicted_queue = queue.Queue(maxsize=2)
+
+    threading.Thread(target=prefetch_frames, args=(roi_queue,), daemon=True).start()
+    threading.Thread(target=store_predictions, args=(predicted_queue,), daemon=True).start()
+
+    # Side and top crops are copied into their halves, reused for every frame.
+    view_concatenated = np.empty((CROP_PIXELS, CROP_PIXELS*2, 3), dtype=np.uint8)
+
     while True:
-        roi_frame_object = redis_db.get_frame("roi")
+        roi_frame_object = roi_queue.get()
 
         roi_frame = roi_frame_object['frame']
         predicted_metadata = roi_frame_object['metadata']
@@ -45,19 +92,28 @@ def run_models():
 
             side_crop = crop_square(
                 roi_frame[:, :roi_frame.shape[1]//3],
-                (side_midpoint[0], side_midpoint[1])
+                (side_midpoint[0], side_midpoint[1]),
+                pixels=CROP_PIXELS
             )
 
             top_crop = crop_square(
                 roi_frame[:, roi_frame.shape[1]//3:],
-                (top_midpoint[0], top_midpoint[1])
+                (top_midpoint[0], top_midpoint[1]),
+                pixels=CROP_PIXELS
             )
 
-            view_concatenated = np.concatenate(
-                (side_crop['croppedFrame'], top_crop['croppedFrame']), axis=1)
+            # crop_square skips the resize when only the width is short, as with narrow side views.
+            if side_crop['croppedFrame'].shape[:2] == top_crop['croppedFrame'].shape[:2] == \
+                    (CROP_PIXELS, CROP_PIXELS):
+                view_concatenated[:, :CROP_PIXELS] = side_crop['croppedFrame']
+                view_concatenated[:, CROP_PIXELS:] = top_crop['croppedFrame']
+                e2e_input = view_concatenated
+            else:
+                e2e_input = np.concatenate(
+                    (side_crop['croppedFrame'], top_crop['croppedFrame']), axis=1)
 
             # Run e2e model
-            predictions = e2e_model.get_predictions(view_concatenated)
+            predictions = e2e_model.get_predictions(e2e_input)
 
             predicted_metadata['roi']['inferences']['location']['crop'] = {}
             predicted_metadata['roi']['inferences']['location']['crop']['topView'] = {}
@@ -73,13 +129,4 @@ def run_models():
             predicted_metadata['roi']['inferences']['e2e']['design'] = predictions['design']
             predicted_metadata['roi']['inferences']['e2e']['category'] = predictions['category']
 
-        # rotated_frame_object = redis_db.get_frame(
-        #     "rotated", frame_uuid=predicted_metadata['rotatedUUID'])
-
-        try:
-            rotated_frame_object = redis_db.get_frame(
-                "raw", frame_uuid=predicted_metadata['rawUUID'])
-
-            redis_db.add_frame("predicted", rotated_frame_object['frame'], predicted_metadata)
-        except Exception as e:
-            print(e)
+        predicted_queue.put(predicted_metadata)
@@ -53,10 +53,16 @@ def combined_roi_views(image, side_rect, top_rect):
     side_M = cv2.getPerspectiveTransform(side_rect, side_dst)
     top_M = cv2.getPerspectiveTransform(top_rect, top_dst)
 
-    side_warped = cv2.warpPerspective(image, side_M, (int(average_height/2), average_height))
-    top_warped = cv2.warpPerspective(image, top_M, (average_height, average_height))
+    # Both views are warped straight into their half of one buffer, no concatenate copy.
+    side_width = int(average_height/2)
+    combined = np.empty((average_height, side_width + average_height, 3), dtype=np.uint8)
 
-    return np.concatenate((side_warped, top_warped), axis=1)
+    cv2.warpPerspective(
+        image, side_M, (side_width, average_height), dst=combined[:, :side_width])
+    cv2.warpPerspective(
+        image, top_M, (average_height, average_height), dst=combined[:, side_width:])
+
+    return combined
 
 
 def capture_regions():
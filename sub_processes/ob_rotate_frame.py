@@ -4,30 +4,58 @@ Ran as a subprocess to correct for the rotation of the camera.
 '''
 
 import time
+from collections import deque
 
 import cv2
+import numpy as np
 
 from modules import ob_storage
 
 
+def rotation_maps(rotation_matrix, frame_shape):
+    '''
+    Precomputes the cv2.remap lookup tables equivalent to warpAffine with rotation_matrix.
+    Each output pixel is mapped back to its source location through the inverse matrix.
+    '''
+    inverse_matrix = cv2.invertAffineTransform(rotation_matrix)
+    grid_x, grid_y = np.meshgrid(
+        np.arange(frame_shape[1], dtype=np.float32),
+        np.arange(frame_shape[0], dtype=np.float32)
+    )
+
+    map_x = inverse_matrix[0, 0]*grid_x + inverse_matrix[0, 1]*grid_y + inverse_matrix[0, 2]
+    map_y = inverse_matrix[1, 0]*grid_x + inverse_matrix[1, 1]*grid_y + inverse_matrix[1, 2]
+
+    # Fixed point maps are smaller and faster to sample than the float pair.
+    return cv2.convertMaps(map_x.astype(np.float32), map_y.astype(np.float32), cv2.CV_16SC2)
+
+
 def rotation_correction(rotation_info):
     '''
     Grabs a frame from the queue and rotates it.
     '''
     redis_db = ob_storage.RedisStorageManager()
 
+    raw_frames = deque()    # Local buffer, refilled in batches from Redis
+
+    # The rotation is fixed for the session, only the lookup tables are built per frame size.
+    rotation_matrix = cv2.getRotationMatrix2D(
+        (rotation_info['aruco_center_x'], rotation_info['aruco_center_y']),
+        rotation_info['angle_offset'], 1)
+    maps_shape, map_1, map_2 = None, None, None
+
     while True:
         try:
-            frame_object = redis_db.get_frame("raw", delete_frame=False)    # Get frame from queue
+            while not raw_frames:
+                raw_frames.extend(redis_db.get_frames("raw", delete_frame=False))
+
+            frame_object = raw_frames.popleft()     # Get frame from queue
 
-            rotation_matrix = cv2.getRotationMatrix2D(
-                (rotation_info['aruco_center_x'], rotation_info['aruco_center_y']),
-                rotation_info['angle_offset'], 1)
+            if frame_object['frame'].shape[:2] != maps_shape:
+                maps_shape = frame_object['frame'].shape[:2]
+                map_1, map_2 = rotation_maps(rotation_matrix, maps_shape)
 
-            last_frame = cv2.warpAffine(
-                frame_object['frame'], rotation_matrix,
-                (frame_object['frame'].shape[1], frame_object['frame'].shape[0])
-            )
+            last_frame = cv2.remap(frame_object['frame'], map_1, map_2, cv2.INTER_LINEAR)
 
             metadata = {
                 'timestamp': frame_object['metadata']['timestamp'],
@@ -46,3 +74,4 @@ def rotation_correction(rotation_info):
 
         except Exception as e:
             print(e)
+            time.sleep(1)   # Back off, errors like a downed Redis repeat immediately